@@ -5,7 +5,7 @@ from dotenv import load_dotenv
 import uuid
 
 # Import agent components
-from langgraph_agent import invoke_agent
+from langgraph_agent import stream_agent
 
 # Setup
 load_dotenv()
@@ -22,6 +22,11 @@ if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
 if "actor_id" not in st.session_state:
     st.session_state.actor_id = "user-tanpat"
+# None = ยังไม่รู้ ให้ invoke_agent โหลดจาก checkpoint ในคำถามแรก
+if "schema_info" not in st.session_state:
+    st.session_state.schema_info = None
+if "sample_data" not in st.session_state:
+    st.session_state.sample_data = None
 
 # Header
 st.title("🚀 Text2SQL Agent with Memory")
@@ -37,8 +42,20 @@ with st.sidebar:
     if st.button("🔄 Reset Session", use_container_width=True):
         st.session_state.session_id = str(uuid.uuid4())
         st.session_state.chat_history = []
+        st.session_state.schema_info = None
+        st.session_state.sample_data = None
         st.rerun()
 
+
+def show_result(table):
+    """แสดงผล query เต็ม (agent เห็นแค่ส่วนที่ถูกตัด)"""
+    with st.expander(f"📊 Query result ({len(table['rows'])} rows)"):
+        st.dataframe(
+            {c: [row[i] for row in table["rows"]] for i, c in enumerate(table["cols"])},
+            use_container_width=True,
+        )
+
+
 # Main chat area
 st.subheader("💬 Conversation")
 
@@ -52,12 +69,17 @@ with chat_container:
         else:
             with st.chat_message("assistant"):
                 st.write(msg["content"])
+                if msg.get("table"):
+                    show_result(msg["table"])
 
 # Input area
 st.divider()
 user_input = st.chat_input("Ask me about your database...", key="chat_input")
 
 if user_input:
+    # Previous questions in this session (context for the response cache)
+    prior_questions = [m["content"] for m in st.session_state.chat_history if m["role"] == "user"]
+    
     # Add user message to history
     st.session_state.chat_history.append({"role": "user", "content": user_input})
     
@@ -71,22 +93,34 @@ if user_input:
         status_placeholder.info("🤔 Agent is thinking...")
         
         try:
-            # Call agent
-            response = invoke_agent(
+            # Call agent and stream the response as it is generated
+            state = {}
+            results = []
+            
+            response = st.write_stream(stream_agent(
                 question=user_input,
                 actor_id=st.session_state.actor_id,
                 session_id=st.session_state.session_id,
-                reset_memory=False
-            )
+                prev_schema=st.session_state.schema_info,
+                prev_sample=st.session_state.sample_data,
+                state_out=state,
+                prior_questions=prior_questions,
+                on_status=lambda msg: status_placeholder.warning(f"🛠️ {msg}"),
+                on_result=results.append,
+            ))
+            st.session_state.schema_info = state.get("schema_info", st.session_state.schema_info)
+            st.session_state.sample_data = state.get("sample_data", st.session_state.sample_data)
             
             # Update status
             status_placeholder.empty()
             
-            # Display response
-            st.write(response)
+            # Full query result (the agent only sees a truncated preview)
+            table = results[-1] if results else None
+            if table:
+                show_result(table)
             
-            # Add to history
-            st.session_state.chat_history.append({"role": "assistant", "content": response})
+            # Add to history (เก็บ table ไว้กับคำตอบเพื่อแสดงซ้ำตอน rerun)
+            st.session_state.chat_history.append({"role": "assistant", "content": response, "table": table})
             
         except Exception as e:
             status_placeholder.error(f"❌ Error: {str(e)}")
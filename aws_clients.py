@@ -0,0 +1,18 @@
+import functools
+import boto3
+from botocore.config import Config
+
+# Shared botocore config: pool ใหญ่ขึ้น + keep-alive เพื่อลดการ handshake ซ้ำ
+BOTO_CONFIG = Config(
+    max_pool_connections=50,
+    tcp_keepalive=True,
+    retries={'max_attempts': 10, 'mode': 'adaptive'},
+    connect_timeout=5,
+    read_timeout=60,
+)
+
+
+@functools.lru_cache(maxsize=None)
+def get_client(service_name, region_name=None):
+    """คืน boto3 client ตัวเดียวต่อ (service, region) ใช้ซ้ำได้ทั้ง process"""
+    return boto3.client(service_name, region_name=region_name, config=BOTO_CONFIG)
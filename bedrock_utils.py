@@ -1,39 +1,52 @@
-import json
 import os
-import boto3
+import orjson
 from dotenv import load_dotenv
+from aws_clients import get_client
 
 load_dotenv()
 
 # Global Bedrock client
 REGION_NAME = os.getenv('AWS_DEFAULT_REGION')
-BEDROCK = boto3.client('bedrock-runtime', region_name=REGION_NAME)
+BEDROCK = get_client('bedrock-runtime', REGION_NAME)
+DEBUG_MODEL_ID = os.getenv('DEBUG_MODEL_ID', 'amazon.nova-pro-v1:0')
 
 
-def _call_bedrock(payload: dict, modelId, encode: bool = False) -> dict:
+# โครง payload (Nova messages) คงที่ทุกครั้ง จึง encode ไว้ครั้งเดียว เหลือ encode แค่ตัว prompt
+_USER_PAYLOAD_HEAD = b'{"messages":[{"role":"user","content":[{"text":'
+_USER_PAYLOAD_TAIL = b'}]}]}'
+
+
+def _user_payload(prompts: str) -> bytes:
+    """สร้าง request body (bytes) สำหรับ prompt ของ user หนึ่งข้อความ"""
+    return _USER_PAYLOAD_HEAD + orjson.dumps(prompts) + _USER_PAYLOAD_TAIL
+
+
+def _call_bedrock(body: bytes, modelId) -> dict:
     """Internal helper to invoke Bedrock and return parsed JSON response."""
-    body = json.dumps(payload).encode('utf-8') if encode else json.dumps(payload)
     resp = BEDROCK.invoke_model(
         body=body,
         modelId=modelId,
         accept='application/json',
         contentType='application/json',
     )
-    return json.loads(resp['body'].read())
+    return orjson.loads(resp['body'].read())
 
 
-def query_llm(prompts: str, modelId):
+def query_llm(prompts: str, modelId, system: list[str] | None = None):
     """แปลงภาษามนุษย์ -> SQL (คืนข้อความผลลัพธ์ตรงๆ)
 
     ห้ามเปลี่ยน logic: จะคืนค่า model_response["output"]["message"]["content"][0]["text"]
+    เรียกผ่าน Converse API; system คือข้อความที่คงที่ข้ามหลายคำขอ (เช่น schema/sample)
+    จะถูกปิดท้ายด้วย cachePoint เพื่อให้ Bedrock prompt caching ใช้ prefix เดิมซ้ำ
     """
-    payload = {
-        'messages': [
-            {'role': 'user', 'content': [{'text': prompts}]}
-        ]
-    }
-
-    model_response = _call_bedrock(payload, modelId, encode=False)
+    kwargs = {}
+    if system:
+        kwargs['system'] = [{'text': t} for t in system] + [{'cachePoint': {'type': 'default'}}]
+    model_response = BEDROCK.converse(
+        modelId=modelId,
+        messages=[{'role': 'user', 'content': [{'text': prompts}]}],
+        **kwargs,
+    )
     # Nova Pro ตอบใน outputs[0].content[0]["text"] ตามโค้ดเดิม
     return model_response['output']['message']['content'][0]['text']
 
@@ -43,28 +56,26 @@ def qna_llm(prompts: str, modelId):
 
     คืนข้อความเหมือนเดิม แต่มีการจัดการกรณีรูปแบบตอบไม่คาดคิด
     """
-    payload = {'messages': [{'role': 'user', 'content': [{'text': prompts}]}]}
-
-    model_response = _call_bedrock(payload, modelId, encode=True)
+    model_response = _call_bedrock(_user_payload(prompts), modelId)
     try:
         return model_response['output']['message']['content'][0]['text']
     except (KeyError, IndexError):
         return f"Unexpected response format: {model_response}"
 
 
-def llm_debugger(statement: str, error: str, params: dict) -> str:
+def llm_debugger(statement: str, error: str, debug_context: dict, modelId=DEBUG_MODEL_ID) -> str:
     """สร้าง prompt สำหรับดีบักข้อผิดพลาด SQL (คืนเฉพาะ SQL ที่แก้แล้ว)
 
-    หลีกเลี่ยงการเปลี่ยน logic: ใช้ query_llm(prompts, modelId=None) เหมือนเดิม
+    debug_context คือ {'schema', 'sample', 'prompt'} ของคำถามนั้น (key ที่ไม่มีจะถือเป็นค่าว่าง)
     """
     prompts = rf'''<s><<SYS>>[INST]
 You are a PostgreSQL developer who is an expert at debugging errors.
 
 Here are the schema definition of table(s):
-{params['schema']}
+{debug_context.get('schema', '')}
 #############################
 Here are example records for each table:
-{params['sample']}
+{debug_context.get('sample', '')}
 #############################
 Here is the sql statement that threw the error below:
 {statement}
@@ -73,7 +84,7 @@ Here is the error to debug:
 {error}
 #############################
 Here is the intent of the user:
-{params['prompt']}
+{debug_context.get('prompt', '')}
 <</SYS>>
 First understand the error and think about how you can fix the error.
 Use the provided schema and sample row to guide your thought process for a solution.
@@ -88,5 +99,5 @@ When generating the correct SQL statement:
 Format your response as:
 <sql> Correct SQL Statement </sql>[/INST]'''
 
-    answer = query_llm(prompts, modelId=None)
+    answer = query_llm(prompts, modelId)
     return answer.replace('\\', '')
@@ -1,28 +1,30 @@
 import os
 import re
 import logging
+import functools
+import threading
+import orjson
+from cachetools import TTLCache, cached
+from cachetools.keys import hashkey
 from dotenv import load_dotenv
 
 # LangGraph & LangChain imports
-from langchain_core.messages import HumanMessage
-from langchain.chat_models import init_chat_model
-from langgraph.graph import StateGraph, END
-from langgraph.prebuilt import ToolNode
-
-# AWS AgentCore Memory imports
-from langgraph_checkpoint_aws import (
-    AgentCoreMemorySaver, 
-    AgentCoreMemoryStore
-)
-# Tool decorator
-from langchain.tools import tool
+# (init_chat_model, ToolNode, graph builder และ AgentCore Memory import ใน factory ด้านล่าง
+#  เพื่อไม่ให้ Streamlit ต้องโหลดตอน render ครั้งแรก)
+from langchain_core.messages import AIMessage, HumanMessage
+
+# Tool decorator (ใช้ของ langchain_core เพราะ langchain.tools จะ import langgraph.prebuilt ไปด้วย)
+from typing import Annotated
+from langchain_core.tools import InjectedToolArg, tool
 
 # Utility imports
 from bedrock_utils import query_llm
 from redshift_utils import (
+    MAX_DEBUG_TRIES,
+    NO_RESULT_MESSAGES,
     execute_query_redshift,
     execute_query_with_pagination,
-    redshift_querys
+    run_and_fetch
 )
 
 # -------------------- Setup --------------------
@@ -39,6 +41,104 @@ DATABASE = os.getenv("DATABASE", "dev")
 DB_USER = os.getenv("DB_USER", "tanpat")
 SQL_MODEL_ID = "amazon.nova-pro-v1:0"
 
+_SQL_RE = re.compile(r"<sql>(.*?)(?:</sql>|$)", re.DOTALL)
+
+# ผล query ที่ส่งเข้า message list ถูกตัดให้อยู่ใน budget นี้ (ผลเต็มส่งให้ UI ทาง custom stream)
+RESULT_MAX_ROWS = 50
+RESULT_MAX_CHARS = 4096
+
+
+def _emit(event: dict):
+    """ส่ง event ออกทาง stream_mode="custom" ให้ UI (ไม่ทำอะไรถ้าไม่ได้รันอยู่ใน graph)"""
+    from langgraph.config import get_stream_writer
+
+    try:
+        writer = get_stream_writer()
+    except RuntimeError:
+        return
+    writer(event)
+
+
+def _report_debug_status(attempt: int, error: str):
+    """ส่งสถานะการดีบัก SQL ให้ UI แสดงระหว่างรอ"""
+    _emit({"status": f"SQL failed, still debugging (attempt {attempt}/{MAX_DEBUG_TRIES}): {error[:200]}"})
+
+
+def _json_default(value):
+    """ค่าที่ orjson แปลงเองไม่ได้ เช่น blobValue (bytes) ให้เป็น hex string"""
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    return str(value)
+
+
+def _clip_row(row: list, limit: int) -> list:
+    """ตัด cell ที่ยาวให้แถวเดียวไม่เกิน limit โดยประมาณ (แบ่ง budget เท่าๆ กันต่อ cell)"""
+    per_cell = max(limit // max(len(row), 1), 16)
+    clipped = []
+    for v in row:
+        if isinstance(v, (bytes, bytearray)):
+            v = _json_default(v)
+        if isinstance(v, str) and len(v) > per_cell:
+            v = f"{v[:per_cell]}...[truncated {len(v) - per_cell} chars]"
+        clipped.append(v)
+    return clipped
+
+
+def _compact_result(table: dict) -> str:
+    """แปลงผล query เป็น JSON {"cols", "rows"} ที่ตัดแถวให้อยู่ใน RESULT_MAX_ROWS/RESULT_MAX_CHARS
+
+    เก็บอย่างน้อย 1 แถวเสมอ (ถ้าแถวแรกใหญ่เกิน budget จะตัด cell ที่ยาวให้แทน)
+    """
+    rows = table["rows"]
+    kept, size = [], len(orjson.dumps(table["cols"]))
+    for row in rows[:RESULT_MAX_ROWS]:
+        row_size = len(orjson.dumps(row, default=_json_default)) + 1
+        if size + row_size > RESULT_MAX_CHARS:
+            if not kept:
+                kept.append(_clip_row(row, RESULT_MAX_CHARS - size))
+            break
+        size += row_size
+        kept.append(row)
+    text = orjson.dumps({"cols": table["cols"], "rows": kept}, default=_json_default).decode()
+    if len(kept) < len(rows):
+        text += f"\n...{len(rows) - len(kept)} more rows"
+    return text
+
+# -------------------- Cached Redshift Fetches --------------------
+# schema/sample แทบไม่เปลี่ยน จึง cache ข้าม session ไว้ 1 ชั่วโมง
+# (ทุกกรณีที่ล้มเหลวต้อง raise ออกไป ไม่ใช่ return ข้อความ error เพื่อไม่ให้ถูก cache)
+
+@cached(TTLCache(maxsize=32, ttl=3600), lock=threading.Lock())
+def _fetch_schema(schema_name: str) -> str:
+    sql = (
+        "SELECT table_catalog,table_schema,table_name,column_name,"
+        "ordinal_position,is_nullable,data_type "
+        "FROM information_schema.columns WHERE table_schema = :schema"
+    )
+    sql_parameters = [{"name": "schema", "value": schema_name}]
+    debug_context = {
+        "schema": "",
+        "sample": "",
+        "prompt": f"List every column of every table in schema '{schema_name}' from information_schema.columns",
+    }
+    result = run_and_fetch(sql, CONNECTION_PARAM, DATABASE, sql_parameters, debug_context,
+                           on_debug=_report_debug_status)
+    if result[0] in NO_RESULT_MESSAGES:
+        raise RuntimeError(result[0])
+    return result[0]
+
+
+@cached(
+    TTLCache(maxsize=32, ttl=3600),
+    key=lambda schema_name, tables: hashkey(schema_name, tuple(sorted(tables))),
+    lock=threading.Lock(),
+)
+def _fetch_sample_data(schema_name: str, tables: tuple) -> dict:
+    """คืน {table: csv}; key ของ cache ไม่สนลำดับ table ส่วนผู้เรียกเรียงผลเองตามที่ขอ"""
+    sqls = [f"SELECT * FROM {schema_name}.{t} LIMIT 3" for t in tables]
+    results = execute_query_with_pagination(sqls, CONNECTION_PARAM, DATABASE)
+    return dict(zip(tables, results))
+
 # -------------------- Core Tools (5 tools) --------------------
 
 @tool
@@ -54,14 +154,7 @@ def get_database_schema(schema_name: str) -> str:
     """
     logger.info(f"*** get_database_schema: {schema_name} ***")
     try:
-        sql = (
-            "SELECT table_catalog,table_schema,table_name,column_name,"
-            "ordinal_position,is_nullable,data_type "
-            f"FROM information_schema.columns WHERE table_schema='{schema_name}'"
-        )
-        resp = execute_query_redshift(sql, CONNECTION_PARAM, DATABASE)
-        result = redshift_querys(sql, resp, {}, CONNECTION_PARAM, DATABASE)
-        return result[0]
+        return _fetch_schema(schema_name)
     except Exception as e:
         logger.error(f"get_database_schema error: {e}")
         return f"Error: {e}"
@@ -80,31 +173,33 @@ def get_sample_data(schema_name: str, table_names: str) -> str:
     """
     logger.info(f"*** get_sample_data: {table_names} ***")
     try:
-        tables = [t.strip() for t in table_names.split(',')]
-        sqls = [f"SELECT * FROM {schema_name}.{t} LIMIT 3" for t in tables]
-        results = execute_query_with_pagination(sqls, CONNECTION_PARAM, DATABASE)
-        return "\n\n".join(results)
+        tables = tuple(t.strip() for t in table_names.split(','))
+        samples = _fetch_sample_data(schema_name, tables)
+        return "\n\n".join(samples[t] for t in tables)
     except Exception as e:
         logger.error(f"get_sample_data error: {e}")
         return f"Error: {e}"
 
 @tool
-def generate_sql_with_context(question: str, schema_info: str = "", sample_data: str = "") -> str:
+def generate_sql_with_context(
+    question: str,
+    schema_info: Annotated[str, InjectedToolArg] = "",
+    sample_data: Annotated[str, InjectedToolArg] = "",
+) -> str:
     """
     Generate a SQL query based on user question, schema structure, and sample data.
+    The cached schema and sample data are supplied automatically.
     
     Args:
         question: The user's question in natural language
-        schema_info: Database schema information
-        sample_data: Sample data from relevant tables
     
     Returns:
         A valid PostgreSQL/Redshift SQL query
     """
     logger.info("*** generate_sql_with_context ***")
     try:
-        prompts = f"""<s><<SYS>>[INST]
-You are an expert PostgreSQL/Redshift developer working with a pet food sales database.
+        # schema/sample/instructions คงที่ตลอด session จึงส่งเป็น system block ที่ Bedrock cache ได้
+        system_prompt = f"""You are an expert PostgreSQL/Redshift developer working with a pet food sales database.
 
 Database Context:
 - Tables: Product_Catalog (pet food products), Sales_Transaction_Details (sales records)
@@ -120,7 +215,6 @@ Sample Data:
 ########
 {sample_data}
 ########
-<</SYS>>
 
 Instructions:
 1. Always include schema name for tables (e.g., public.product_catalog)
@@ -133,12 +227,10 @@ Instructions:
 Return ONLY the SQL query inside <sql> tags:
 <sql>
 your SQL query here
-</sql>
-
-User Question: {question}[/INST]"""
+</sql>"""
 
-        response = query_llm(prompts, SQL_MODEL_ID)
-        match = re.search(r"<sql>(.*?)(?:</sql>|$)", response, re.DOTALL)
+        response = query_llm(f"User Question: {question}", SQL_MODEL_ID, system=[system_prompt])
+        match = _SQL_RE.search(response)
         return match.group(1).strip().replace("\\", "") if match else response
     except Exception as e:
         logger.error(f"generate_sql_with_context error: {e}")
@@ -169,35 +261,40 @@ def quick_test_sql(sql_query: str) -> str:
         return f"SQL Failed: {e}"
 
 @tool
-def query_existing_table(sql_query: str) -> str:
+def query_existing_table(
+    sql_query: str,
+    schema_info: Annotated[str, InjectedToolArg] = "",
+    sample_data: Annotated[str, InjectedToolArg] = "",
+    question: Annotated[str, InjectedToolArg] = "",
+) -> str:
     """
     Execute a SQL query and retrieve actual data from the database.
+    Failed queries are debugged automatically using the cached schema and sample data.
     
     Args:
         sql_query: The SQL query to execute
     
     Returns:
-        Query results in CSV format
+        Query results as JSON {"cols": [...], "rows": [[...]]}, truncated to the first rows
+        with a "...N more rows" note when the result is large
     """
     logger.info("*** query_existing_table: execute ***")
     try:
-        resp = execute_query_redshift(sql_query, CONNECTION_PARAM, DATABASE)
-        result = redshift_querys(sql_query, resp, {}, CONNECTION_PARAM, DATABASE)
-        return result[0]
+        debug_context = {"schema": schema_info, "sample": sample_data, "prompt": question}
+        table, _ = run_and_fetch(sql_query, CONNECTION_PARAM, DATABASE, debug_context=debug_context,
+                                 on_debug=_report_debug_status, as_dict=True)
+        if isinstance(table, str):  # ดีบักไม่สำเร็จ
+            return table
+        _emit({"result": table})
+        return _compact_result(table)
     except Exception as e:
         logger.error(f"query_existing_table error: {e}")
         return f"Error: {e}"
 
-from langgraph.graph import MessagesState
-from typing_extensions import NotRequired
-
-class CustomState(MessagesState):
-    schema_info: NotRequired[str]
-    sample_data: NotRequired[str]
 
 # -------------------- LangGraph Nodes --------------------
 
-def should_continue(state: MessagesState):
+def should_continue(state: dict):
     """
     Determine whether to continue calling tools or end the workflow.
     
@@ -217,18 +314,49 @@ def should_continue(state: MessagesState):
         return "end"
     return "continue"
 
-from langchain_core.messages import SystemMessage
+from langchain_core.messages import SystemMessage, ToolMessage
+
+# ส่ง history ให้ LLM แค่ช่วงล่าสุด และย่อผล tool ของคำถามก่อนหน้า (state เต็มยังอยู่ใน checkpoint)
+MAX_HISTORY_MESSAGES = 12
+MAX_OLD_TOOL_CHARS = 1000
+MAX_EARLIER_QUESTIONS = 10
+
+
+def _trim_messages(messages):
+    """คืน (window, dropped_questions) โดย window เริ่มที่ HumanMessage เสมอเพื่อไม่ตัดคู่ tool call/result"""
+    start = max(len(messages) - MAX_HISTORY_MESSAGES, 0)
+    while start > 0 and not isinstance(messages[start], HumanMessage):
+        start -= 1
+    dropped = [m.content for m in messages[:start] if isinstance(m, HumanMessage)][-MAX_EARLIER_QUESTIONS:]
+    last_human = max((i for i, m in enumerate(messages) if isinstance(m, HumanMessage)), default=0)
 
-def call_model(state: CustomState):
+    window = []
+    for i, m in enumerate(messages[start:], start):
+        if (i < last_human and isinstance(m, ToolMessage)
+                and isinstance(m.content, str) and len(m.content) > MAX_OLD_TOOL_CHARS):
+            extra = len(m.content) - MAX_OLD_TOOL_CHARS
+            m = m.model_copy(update={"content": f"{m.content[:MAX_OLD_TOOL_CHARS]}\n...[truncated {extra} chars]"})
+        window.append(m)
+    return window, dropped
+
+
+def call_model(state: dict):
     cached_schema = state.get('schema_info', '')
     cached_sample = state.get('sample_data', '')
     
     logger.info(f"[call_model] Schema cached: {len(cached_schema)} chars | Sample cached: {len(cached_sample)} chars")
     
+    history, dropped = _trim_messages(state["messages"])
+    earlier = "\n".join(f"- {q}" for q in dropped) if dropped else "None"
+    if dropped:
+        logger.info(f"[call_model] Trimmed history: {len(state['messages']) - len(history)} messages dropped")
+    
     system_msg = SystemMessage(content=f"""You are a Text-to-SQL expert assistant.
 
 Cached Schema: {cached_schema[:200] if cached_schema else 'Not loaded'}
 Cached Sample Data: {cached_sample[:200] if cached_sample else 'Not loaded'}
+Earlier Questions (most recent {MAX_EARLIER_QUESTIONS}, older turns omitted):
+{earlier}
 
 STRICT WORKFLOW (follow in order):
 1. Load database schema/data: Call get_database_schema ONLY if NOT cached. Call get_sample_data ONLY if NOT cached.
@@ -240,10 +368,11 @@ CRITICAL RULES:
 - NEVER call generate_sql_with_context multiple times for the same query
 - Once quick_test_sql passes, proceed to query_existing_table immediately
 - If SQL has issues, explain to user instead of regenerating infinitely
-- Reuse cached schema/sample data from previous questions""")
+- Reuse cached schema/sample data from previous questions
+- generate_sql_with_context receives the full cached schema/sample data automatically; pass only the question""")
     
-    messages = [system_msg] + state["messages"]
-    response = llm_with_tools.invoke(messages)
+    messages = [system_msg] + history
+    response = get_llm_with_tools().invoke(messages)
     
     tool_calls = getattr(response, 'tool_calls', None)
     if tool_calls:
@@ -253,11 +382,32 @@ CRITICAL RULES:
     return {"messages": [response]}
 
 
-def tools_with_state_update(state: CustomState):
+def tools_with_state_update(state: dict):
     """Execute tools และอัปเดต state"""
+    from langgraph.prebuilt import ToolNode
+
+    # เติม schema/sample เต็มจาก state ให้ generate_sql_with_context/query_existing_table ฝั่ง server
+    # (ToolMessage เดิมของ schema/sample อาจถูกย่อหรือหลุด window ไปแล้วในมุมมองของ LLM)
+    # ทำบนสำเนาของ message เพื่อไม่ให้ args ก้อนใหญ่ถูกบันทึกลง history
+    last_message = state["messages"][-1]
+    context = {
+        "schema_info": state.get("schema_info", ""),
+        "sample_data": state.get("sample_data", ""),
+    }
+    question = next((m.content for m in reversed(state["messages"]) if isinstance(m, HumanMessage)), "")
+    tool_calls = []
+    for tc in last_message.tool_calls:
+        if tc["name"] == "generate_sql_with_context":
+            tc = {**tc, "args": {**tc["args"], **context}}
+        elif tc["name"] == "query_existing_table":
+            # คำถามล่าสุดใช้เป็น intent ให้ llm_debugger ตอน query ล้มเหลว
+            tc = {**tc, "args": {**tc["args"], **context, "question": question}}
+        tool_calls.append(tc)
+    patched = last_message.model_copy(update={"tool_calls": tool_calls})
+
     # เรียก tools ปกติ
     tool_node = ToolNode(tools)
-    result = tool_node.invoke(state)
+    result = tool_node.invoke({**state, "messages": state["messages"][:-1] + [patched]})
 
     # ดึงผลลัพธ์จาก tool messages
     # Preserve existing schema/sample values unless a tool explicitly updates them
@@ -268,6 +418,9 @@ def tools_with_state_update(state: CustomState):
     }
 
     for msg in result["messages"]:
+        # tool ที่ล้มเหลวต้องไม่ทับค่า schema/sample เดิมด้วยข้อความ error
+        if getattr(msg, 'status', None) == "error" or str(msg.content).startswith("Error:"):
+            continue
         if hasattr(msg, 'name'):
             if msg.name == "get_database_schema":
                 updates["schema_info"] = msg.content
@@ -289,45 +442,61 @@ tools = [
     query_existing_table,
 ]
 
-# Initialize LLM with tools
-llm = init_chat_model(
-    MODEL_ID, 
-    model_provider="bedrock_converse", 
-    region_name=REGION
-)
-llm_with_tools = llm.bind_tools(tools)
-
-# สร้าง checkpointer และ store สำหรับ AgentCore
-checkpointer = AgentCoreMemorySaver(MEMORY_ID, region_name=REGION)
-store = AgentCoreMemoryStore(memory_id=MEMORY_ID)
-
-# สร้าง graph
-workflow = StateGraph(CustomState)
-workflow.add_node("agent", call_model)
-
-# เปลี่ยนจาก ToolNode(tools) เป็น custom function
-from langgraph.types import CachePolicy
+@functools.lru_cache()
+def get_llm_with_tools():
+    """สร้าง LLM ที่ bind tools แล้วครั้งเดียวต่อ process"""
+    from langchain.chat_models import init_chat_model
 
-workflow.add_node(
-    "tools",
-    tools_with_state_update,
-    cache_policy=CachePolicy(ttl=300)  # cache 5 นาที
-)
-workflow.set_entry_point("agent")
-workflow.add_conditional_edges("agent", should_continue, {"continue": "tools", "end": END})
-workflow.add_edge("tools", "agent")
-
-
-# Compile พร้อม checkpointer และ store
-app = workflow.compile(
-    checkpointer=checkpointer,
-    store=store, 
-)
+    llm = init_chat_model(
+        MODEL_ID, 
+        model_provider="bedrock_converse", 
+        region_name=REGION
+    )
+    return llm.bind_tools(tools)
+
+
+@functools.lru_cache()
+def get_app():
+    """Compile graph พร้อม AgentCore checkpointer/store ครั้งเดียวต่อ process"""
+    from typing_extensions import NotRequired
+    from langgraph.graph import StateGraph, MessagesState, END
+    from langgraph.types import CachePolicy
+    from langgraph_checkpoint_aws import AgentCoreMemorySaver, AgentCoreMemoryStore
+
+    class CustomState(MessagesState):
+        schema_info: NotRequired[str]
+        sample_data: NotRequired[str]
+
+    # สร้าง checkpointer และ store สำหรับ AgentCore
+    checkpointer = AgentCoreMemorySaver(MEMORY_ID, region_name=REGION)
+    store = AgentCoreMemoryStore(memory_id=MEMORY_ID)
+
+    # สร้าง graph
+    workflow = StateGraph(CustomState)
+    workflow.add_node("agent", call_model)
+
+    # เปลี่ยนจาก ToolNode(tools) เป็น custom function
+    workflow.add_node(
+        "tools",
+        tools_with_state_update,
+        cache_policy=CachePolicy(ttl=300)  # cache 5 นาที
+    )
+    workflow.set_entry_point("agent")
+    workflow.add_conditional_edges("agent", should_continue, {"continue": "tools", "end": END})
+    workflow.add_edge("tools", "agent")
+
+    # Compile พร้อม checkpointer และ store
+    return workflow.compile(
+        checkpointer=checkpointer,
+        store=store, 
+    )
 
 
 # -------------------- Main Execution --------------------
 
 import time
+import uuid
+import hashlib
 from botocore.exceptions import ClientError
 
 
@@ -335,7 +504,7 @@ def get_previous_state(thread_id: str, actor_id: str):
     """Retrieve the previous state from checkpointer to preserve memory."""
     try:
         # Get the saved checkpoint state for this thread
-        saved_state = app.get_state(
+        saved_state = get_app().get_state(
             config={
                 "configurable": {
                     "thread_id": thread_id,
@@ -353,12 +522,108 @@ def get_previous_state(thread_id: str, actor_id: str):
     return {"schema_info": "", "sample_data": ""}
 
 
-def invoke_agent(
+# -------------------- Response Cache --------------------
+# คำถามเดิมในบริบทเดิม (คำถามก่อนหน้าใน session + schema เดียวกัน) ได้คำตอบเดิม ไม่ต้องรัน graph ใหม่
+_response_cache = TTLCache(maxsize=1000, ttl=900)
+_response_cache_lock = threading.Lock()
+
+
+def _response_cache_key(question: str, prior_questions: list[str], schema_info: str) -> str:
+    schema_hash = hashlib.blake2b(schema_info.encode(), digest_size=16).hexdigest()
+    context = "\x1f".join(prior_questions)
+    return hashlib.blake2b(f"{question}|{context}|{schema_hash}".encode()).hexdigest()
+
+
+def _lookup_cached_response(config: dict, question: str, prior_questions, schema_info: str):
+    """คืน (cache_key, entry) โดย entry เป็น None ถ้า miss หรือผู้เรียกไม่ส่ง prior_questions มา
+
+    ถ้า hit จะบันทึกคำถาม/คำตอบลง checkpoint ของ thread นี้ด้วย เพื่อให้คำถามต่อเนื่องยังมีบริบท
+    """
+    if prior_questions is None:
+        return None, None
+    key = _response_cache_key(question, prior_questions, schema_info)
+    with _response_cache_lock:
+        entry = _response_cache.get(key)
+    if entry is not None:
+        logger.info("[cache] Response cache hit")
+        get_app().update_state(
+            config,
+            {
+                "messages": [HumanMessage(content=question), AIMessage(content=entry["response"])],
+                "schema_info": entry["schema_info"],
+                "sample_data": entry["sample_data"],
+            },
+            as_node="agent",
+        )
+    return key, entry
+
+
+def _run_had_tool_error(messages) -> bool:
+    """ตรวจ ToolMessage ของคำถามล่าสุด (หลัง HumanMessage สุดท้าย) ว่ามี tool ที่ล้มเหลวหรือไม่"""
+    for msg in reversed(messages):
+        if isinstance(msg, HumanMessage):
+            return False
+        if isinstance(msg, ToolMessage):
+            content = str(msg.content)
+            if (msg.status == "error" or content in NO_RESULT_MESSAGES
+                    or content.startswith(("Error:", "SQL Failed:"))):
+                return True
+    return False
+
+
+def _store_cached_response(key, response, final_state: dict, table=None):
+    """เก็บคำตอบลง cache เฉพาะ run ที่ทุก tool สำเร็จ (ไม่ pin คำตอบที่มาจาก error)"""
+    if key is None:
+        return
+    if _run_had_tool_error(final_state.get("messages", [])):
+        logger.info("[cache] Skip caching response: a tool failed during this run")
+        return
+    with _response_cache_lock:
+        _response_cache[key] = {
+            "response": response,
+            "schema_info": final_state.get("schema_info", ""),
+            "sample_data": final_state.get("sample_data", ""),
+            "table": table,
+        }
+
+
+def _message_text(message) -> str:
+    """ดึงเฉพาะ text จาก message (content อาจเป็น str หรือ list ของ content block)"""
+    content = getattr(message, 'content', message)
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(
+            block.get("text", "") if isinstance(block, dict) else str(block)
+            for block in content
+            if not isinstance(block, dict) or block.get("type", "text") == "text"
+        )
+    return str(content)
+
+
+def stream_agent(
     question: str,
     actor_id: str = "redshift-agent",
     session_id: str = "session-1",
     reset_memory: bool = False,
+    prev_schema: str | None = None,
+    prev_sample: str | None = None,
+    state_out: dict | None = None,
+    prior_questions: list[str] | None = None,
+    on_status=None,
+    on_result=None,
 ):
+    """ถาม agent หนึ่งคำถาม แล้ว yield ข้อความของ agent ทีละ token (ใช้กับ st.write_stream)
+
+    yield เฉพาะ text delta ของ agent node (tool-call args ไม่ถูกส่งออก) ถ้า turn ไหนพูดนำ
+    ก่อนเรียก tool ข้อความนั้นจะแสดงไปแล้วและคั่นกับ turn ถัดไปด้วยบรรทัดว่าง
+    คำตอบที่ cache ไว้คือข้อความทั้งหมดที่ yield ออกไป (ตรงกับที่ UI แสดง)
+    - prev_schema/prev_sample: state ที่ผู้เรียกเก็บไว้ (เช่นใน st.session_state) ถ้าส่งมาจะข้าม get_previous_state
+    - state_out: dict ที่จะถูกเติม schema_info/sample_data สุดท้ายหลังจบ
+    - prior_questions: คำถามก่อนหน้าใน session ส่งมาเพื่อเปิดใช้ response cache
+    - on_status(message): สถานะระหว่างทาง เช่น SQL กำลังถูกดีบัก
+    - on_result(table): ผล query เต็ม ({"cols", "rows"}) ก่อนถูกตัดให้ LLM
+    """
     config = {
         "configurable": {
             "thread_id": session_id,
@@ -371,14 +636,28 @@ def invoke_agent(
     logger.info(f"Actor: {actor_id} | Session: {session_id}")
     logger.info("=" * 80)
     
-    # --- Load previous state from checkpointer ---
-    if not reset_memory:
-        prev_state = get_previous_state(session_id, actor_id)
-        logger.info(f"[invoke] Loaded from checkpoint - schema: {len(prev_state['schema_info'])} chars, sample: {len(prev_state['sample_data'])} chars")
-    else:
+    # --- Load previous state from caller or checkpointer ---
+    if reset_memory:
         prev_state = {"schema_info": "", "sample_data": ""}
         logger.info("[invoke] Reset memory - starting fresh")
+    elif prev_schema is not None and prev_sample is not None:
+        prev_state = {"schema_info": prev_schema, "sample_data": prev_sample}
+        logger.info(f"[invoke] Using caller state - schema: {len(prev_schema)} chars, sample: {len(prev_sample)} chars")
+    else:
+        prev_state = get_previous_state(session_id, actor_id)
+        logger.info(f"[invoke] Loaded from checkpoint - schema: {len(prev_state['schema_info'])} chars, sample: {len(prev_state['sample_data'])} chars")
     
+    # --- Response cache ---
+    cache_key, cached_entry = _lookup_cached_response(config, question, prior_questions, prev_state["schema_info"])
+    if cached_entry is not None:
+        if on_result and cached_entry["table"] is not None:
+            on_result(cached_entry["table"])
+        if state_out is not None:
+            state_out["schema_info"] = cached_entry["schema_info"]
+            state_out["sample_data"] = cached_entry["sample_data"]
+        yield cached_entry["response"]
+        return
+
     # --- Prepare payload with loaded state ---
     max_retries = 3
     payload = {
@@ -387,14 +666,42 @@ def invoke_agent(
         "sample_data": prev_state["sample_data"],
     }
 
+    response_text, table = "", None
     for attempt in range(max_retries + 1):
+        result, turn_id = None, None
         try:
-            logger.info(f"[invoke] Calling app.invoke with config: {config}")
-            result = app.invoke(payload, config=config)
+            logger.info(f"[invoke] Calling app.stream with config: {config}")
+            stream_mode = ["messages", "values", "custom"]
+            for mode, data in get_app().stream(payload, config=config, stream_mode=stream_mode):
+                if mode == "custom":
+                    if on_status and isinstance(data, dict) and "status" in data:
+                        on_status(data["status"])
+                    if isinstance(data, dict) and "result" in data:
+                        table = data["result"]
+                        if on_result:
+                            on_result(table)
+                    continue
+                if mode == "values":
+                    result = data
+                    continue
+                chunk, metadata = data
+                if metadata.get("langgraph_node") != "agent" or not isinstance(chunk, AIMessage):
+                    continue
+                delta = _message_text(chunk)
+                if not delta:
+                    continue
+                # turn ใหม่ของ agent (LLM call ใหม่) คั่นจากข้อความก่อนหน้าด้วยบรรทัดว่าง
+                if chunk.id != turn_id:
+                    turn_id = chunk.id
+                    if response_text:
+                        delta = "\n\n" + delta
+                response_text += delta
+                yield delta
             logger.info(f"[invoke] Result returned. Final state - schema: {len(result.get('schema_info', ''))} chars, sample: {len(result.get('sample_data', ''))} chars")
             break  # สำเร็จ
         except ClientError as e:
-            if e.response['Error']['Code'] == 'ThrottlingException':
+            # retry ได้เฉพาะตอนที่ยังไม่ได้ส่งคำตอบออกไป
+            if e.response['Error']['Code'] == 'ThrottlingException' and not response_text:
                 if attempt == max_retries:
                     raise
                 wait = (2 ** attempt) + 1  # 3s, 5s, 9s
@@ -412,16 +719,98 @@ def invoke_agent(
     else:
         raise RuntimeError("ไม่สามารถดำเนินการได้หลังจาก retry")
 
-    # --- ดึง response ---
-    final_message = result["messages"][-1]
-    response_text = final_message.content if hasattr(final_message, 'content') else str(final_message)
-    
     logger.info("=" * 80)
     logger.info(f"Agent Response:\n{response_text}")
     logger.info("=" * 80)
     
+    _store_cached_response(cache_key, response_text, result, table)
+    
+    if state_out is not None:
+        state_out["schema_info"] = result.get("schema_info", "")
+        state_out["sample_data"] = result.get("sample_data", "")
+
+
+def invoke_agent(
+    question: str,
+    actor_id: str = "redshift-agent",
+    session_id: str = "session-1",
+    reset_memory: bool = False,
+    prev_schema: str | None = None,
+    prev_sample: str | None = None,
+    return_state: bool = False,
+    prior_questions: list[str] | None = None,
+    on_status=None,
+    on_result=None,
+):
+    """ถาม agent หนึ่งคำถามแล้วคืนคำตอบ (อาร์กิวเมนต์เหมือน stream_agent)
+
+    return_state=True จะคืน (response_text, state) เพื่อให้ผู้เรียกเก็บ
+    schema_info/sample_data ล่าสุดไว้ใช้รอบถัดไป
+    """
+    state = {}
+    response_text = "".join(stream_agent(
+        question,
+        actor_id=actor_id,
+        session_id=session_id,
+        reset_memory=reset_memory,
+        prev_schema=prev_schema,
+        prev_sample=prev_sample,
+        state_out=state,
+        prior_questions=prior_questions,
+        on_status=on_status,
+        on_result=on_result,
+    ))
+    if return_state:
+        return response_text, state
     return response_text
 
+
+def invoke_agent_batch(
+    questions: list[str],
+    actor_id: str = "redshift-agent",
+    session_ids: list[str] | None = None,
+    schema_info: str = "",
+    sample_data: str = "",
+    max_concurrency: int | None = None,
+):
+    """ถามหลายคำถามที่ไม่ขึ้นต่อกันพร้อมกันผ่าน app.batch (เช่น evaluation/offline run)
+
+    แต่ละคำถามต้องใช้ thread ของตัวเอง ถ้าไม่ส่ง session_ids มาจะสร้าง uuid ใหม่ให้ทุกคำถาม
+    คำถามที่ error จะคืนเป็นข้อความ "Error: ..." แทนการ raise ทั้ง batch
+    """
+    if session_ids is None:
+        session_ids = [str(uuid.uuid4()) for _ in questions]
+    if len(session_ids) != len(questions):
+        raise ValueError("session_ids ต้องมีจำนวนเท่ากับ questions")
+
+    payloads = [
+        {
+            "messages": [HumanMessage(content=q)],
+            "schema_info": schema_info,
+            "sample_data": sample_data,
+        }
+        for q in questions
+    ]
+    configs = [
+        {
+            "configurable": {"thread_id": sid, "actor_id": actor_id},
+            "max_concurrency": max_concurrency,
+        }
+        for sid in session_ids
+    ]
+
+    logger.info(f"[batch] Running {len(questions)} questions for actor {actor_id}")
+    results = get_app().batch(payloads, config=configs, return_exceptions=True)
+
+    responses = []
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"[batch] error: {result}")
+            responses.append(f"Error: {result}")
+            continue
+        responses.append(_message_text(result["messages"][-1]))
+    return responses
+
 # -------------------- Entry Point --------------------
 
 if __name__ == "__main__":
@@ -436,7 +825,6 @@ if __name__ == "__main__":
     print("  ✅ Pet Food Sales Database (Products + Transactions)")
     print("=" * 80)
     
-    import uuid
     new_uuid = uuid.uuid4()
 
     # Example usage
@@ -1,15 +1,25 @@
+import io
 import os
+import re
+import csv
 import time
-import boto3
-import pandas as pd
+import random
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from aws_clients import get_client
 from bedrock_utils import llm_debugger
 
 load_dotenv()
 
 # Global Redshift Data API client
 REGION_NAME = os.getenv('AWS_DEFAULT_REGION')
-REDSHIFT_DATA = boto3.client('redshift-data', region_name=REGION_NAME)
+REDSHIFT_DATA = get_client('redshift-data', REGION_NAME)
+
+_SQL_RE = re.compile(r"<sql>(.*?)</sql>", re.DOTALL)
+MAX_DEBUG_TRIES = 5
+DEBUG_FAILED_RESULT = f'DEBUGGING FAILED IN {MAX_DEBUG_TRIES} ATTEMPTS. NO RESULT AVAILABLE'
+QUERY_ABORTED_RESULT = 'QUERY ABORTED. NO RESULT AVAILABLE'
+NO_RESULT_MESSAGES = (DEBUG_FAILED_RESULT, QUERY_ABORTED_RESULT)
 
 
 def get_db_redshift(conn_param, database):
@@ -28,54 +38,93 @@ def get_tables_redshift(conn_param, database, schema):
     return [t['name'] for t in tables['Tables']]
 
 
-def get_redshift_table_result(response):
-    """แปลงผลลัพธ์จาก Redshift query เป็น CSV string"""
+def get_redshift_table_result(response, as_dict=False):
+    """แปลงผลลัพธ์จาก Redshift query เป็น CSV string (as_dict=True คืน {"cols": [...], "rows": [[...]]})"""
     cols = [c['name'] for c in response['ColumnMetadata']]
-    data = [[list(v.values())[0] for v in r] for r in response['Records']]
-    return pd.DataFrame(data, columns=cols).to_csv(index=False)
-
-
-def execute_query_redshift(sql, conn_param, database):
-    """รัน SQL เดียวใน Redshift แล้วคืน response object"""
+    records = response['Records']
+    # แต่ละ cell เป็น dict key เดียว (เช่น {'stringValue': ...}) จึงจำชื่อ key ต่อ column จาก cell แรกที่ไม่ใช่ null
+    keys = [None] * len(cols)
+    for r in records:
+        for ci, v in enumerate(r):
+            if keys[ci] is None and 'isNull' not in v:
+                keys[ci] = next(iter(v))
+        if None not in keys:
+            break
+    rows = ([v.get(k) for k, v in zip(keys, r)] for r in records)
+    if as_dict:
+        return {"cols": cols, "rows": list(rows)}
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator='\n')
+    writer.writerow(cols)
+    writer.writerows(rows)
+    return buf.getvalue()
+
+
+def execute_query_redshift(sql, conn_param, database, sql_parameters=None):
+    """รัน SQL เดียวใน Redshift แล้วคืน response object (sql_parameters ส่งต่อให้ Data API เช่น [{'name': 'schema', 'value': 'public'}])"""
+    if sql_parameters:
+        return REDSHIFT_DATA.execute_statement(**conn_param, Database=database, Sql=sql, Parameters=sql_parameters)
     return REDSHIFT_DATA.execute_statement(**conn_param, Database=database, Sql=sql)
 
 
-def _wait_for_statement(statement_id, timeout=300):
-    """รอให้ statement ทำงานเสร็จ พร้อมตรวจสอบ error"""
+def _poll_statement(statement_id, timeout=300):
+    """poll describe_statement แบบ exponential backoff + jitter จนกว่าจะจบ แล้วคืน desc"""
     start = time.time()
+    sleep = 0.05
     while True:
         if time.time() - start > timeout:
             raise TimeoutError(f"Query timed out after {timeout}s")
         desc = REDSHIFT_DATA.describe_statement(Id=statement_id)
-        status = desc['Status']
-        if status == 'FINISHED':
+        if desc['Status'] in ('FINISHED', 'FAILED', 'ABORTED'):
             return desc
-        if status in ('FAILED', 'ABORTED'):
-            raise RuntimeError(desc.get('Error', 'Unknown error'))
-        time.sleep(1)
+        time.sleep(sleep * random.uniform(0.8, 1.2))
+        sleep = min(sleep * 1.7, 2.0)
+
+
+def _wait_for_statement(statement_id, timeout=300):
+    """รอให้ statement ทำงานเสร็จ พร้อมตรวจสอบ error"""
+    desc = _poll_statement(statement_id, timeout)
+    if desc['Status'] in ('FAILED', 'ABORTED'):
+        raise RuntimeError(desc.get('Error', 'Unknown error'))
+    return desc
+
+
+def _fetch_statement_result(statement_id, timeout=300):
+    """รอ statement เสร็จแล้วดึงผลลัพธ์เป็น CSV string"""
+    _wait_for_statement(statement_id, timeout)
+    res = REDSHIFT_DATA.get_statement_result(Id=statement_id)
+    return get_redshift_table_result(res)
+
+
+def _execute_each_statement(sql_list, conn_param, database, max_wait_seconds=300):
+    """ส่งทุก statement ก่อน แล้วค่อยรอ/ดึงผลแบบขนาน (ลำดับผลลัพธ์ตาม sql_list)"""
+    ids = [execute_query_redshift(sql, conn_param, database)['Id'] for sql in sql_list]
+    if not ids:
+        return []
+    with ThreadPoolExecutor(max_workers=len(ids)) as executor:
+        return list(executor.map(lambda i: _fetch_statement_result(i, max_wait_seconds), ids))
 
 
 def execute_query_with_pagination(sql_list, conn_param, database, max_wait_seconds=300):
     """รองรับการรัน query หลายตัวและรอผลลัพธ์แบบมี timeout"""
     results = []
     try:
-        if 'ClusterIdentifier' in conn_param:
-            resp = REDSHIFT_DATA.batch_execute_statement(**conn_param, Database=database, Sqls=sql_list)
-            desc = _wait_for_statement(resp['Id'], max_wait_seconds)
-            for sub in desc.get('SubStatements', []):
-                if sub.get('Status') == 'FAILED':
-                    raise RuntimeError(sub.get('Error', 'Unknown error'))
-                res = REDSHIFT_DATA.get_statement_result(Id=sub['Id'])
-                results.append(get_redshift_table_result(res))
-
-        elif 'WorkgroupName' in conn_param:
-            for sql in sql_list:
-                resp = execute_query_redshift(sql, conn_param, database)
-                _wait_for_statement(resp['Id'], max_wait_seconds)
-                res = REDSHIFT_DATA.get_statement_result(Id=resp['Id'])
-                results.append(get_redshift_table_result(res))
-        else:
+        if 'ClusterIdentifier' not in conn_param and 'WorkgroupName' not in conn_param:
             raise ValueError('connection_param ต้องมี ClusterIdentifier หรือ WorkgroupName')
+
+        # ใช้ batch API ได้ทั้ง cluster และ serverless workgroup ถ้าถูกปฏิเสธค่อย fallback ทีละ statement
+        try:
+            resp = REDSHIFT_DATA.batch_execute_statement(**conn_param, Database=database, Sqls=sql_list)
+        except REDSHIFT_DATA.exceptions.ValidationException as e:
+            print(f"batch_execute_statement rejected, running statements individually: {e}")
+            return _execute_each_statement(sql_list, conn_param, database, max_wait_seconds)
+
+        desc = _wait_for_statement(resp['Id'], max_wait_seconds)
+        for sub in desc.get('SubStatements', []):
+            if sub.get('Status') == 'FAILED':
+                raise RuntimeError(sub.get('Error', 'Unknown error'))
+            res = REDSHIFT_DATA.get_statement_result(Id=sub['Id'])
+            results.append(get_redshift_table_result(res))
         return results
 
     except Exception as e:
@@ -83,50 +132,52 @@ def execute_query_with_pagination(sql_list, conn_param, database, max_wait_secon
         raise
 
 
-def redshift_querys(q_s, response, params, conn_param, database):
-    """รัน query บน Redshift ถ้า error ให้ดีบัก SQL ด้วย llm_debugger แล้วลองใหม่"""
-    max_try, debug_count = 5, 5
-    try:
-        stmt_result = REDSHIFT_DATA.get_statement_result(Id=response['Id'])
-    except REDSHIFT_DATA.exceptions.ResourceNotFoundException:
-        desc = REDSHIFT_DATA.describe_statement(Id=response['Id'])
-        status = desc['Status']
-        while status in ('SUBMITTED', 'PICKED', 'STARTED'):
-            time.sleep(1)
-            status = REDSHIFT_DATA.describe_statement(Id=response['Id'])['Status']
-
-        while max_try > 0 and status == 'FAILED':
-            max_try -= 1
-            bad_sql, error = desc['QueryString'], desc['Error']
-            print(f"\nDEBUG TRIAL {5 - max_try}\nBAD SQL:\n{bad_sql}\nERROR: {error}\nDEBUGGING...")
-            cql = llm_debugger(bad_sql, error, params)
-            q_s = cql.split('<sql>')[1].split('</sql>')[0].strip()
-            print(f"\nDEBUGGED SQL:\n{q_s}")
-            response = execute_query_redshift(q_s, conn_param, database)
-
-            desc = REDSHIFT_DATA.describe_statement(Id=response['Id'])
-            status = desc['Status']
-            while status in ('SUBMITTED', 'PICKED', 'STARTED'):
-                time.sleep(2)
-                status = REDSHIFT_DATA.describe_statement(Id=response['Id'])['Status']
-
-            if status == 'FINISHED':
-                break
-
-        if max_try == 0 and status == 'FAILED':
-            print(f'DEBUGGING FAILED IN {debug_count} ATTEMPTS')
-        else:
-            for _ in range(5):
-                try:
-                    time.sleep(1)
-                    stmt_result = REDSHIFT_DATA.get_statement_result(Id=response['Id'])
-                    break
-                except REDSHIFT_DATA.exceptions.ResourceNotFoundException:
-                    time.sleep(5)
-
-    if max_try == 0 and status == 'FAILED':
-        result_csv = f'DEBUGGING FAILED IN {debug_count} ATTEMPTS. NO RESULT AVAILABLE'
-    else:
-        result_csv = get_redshift_table_result(stmt_result)
-
-    return result_csv, q_s
+def _extract_sql(text):
+    """ดึง SQL จาก <sql>...</sql> ถ้าไม่มี tag ให้คืนข้อความทั้งหมด"""
+    m = _SQL_RE.search(text)
+    return m.group(1).strip() if m else text.strip()
+
+
+def redshift_querys(q_s, response, debug_context, conn_param, database, sql_parameters=None, on_debug=None, as_dict=False):
+    """รัน query บน Redshift ถ้า error ให้ดีบัก SQL ด้วย llm_debugger แล้วลองใหม่ (สูงสุด MAX_DEBUG_TRIES ครั้ง)
+
+    debug_context คือ {'schema', 'sample', 'prompt'} ที่ส่งให้ llm_debugger
+
+    on_debug(attempt, error) จะถูกเรียกก่อนดีบักแต่ละรอบ ใช้รายงานความคืบหน้าให้ UI
+    as_dict ส่งต่อให้ get_redshift_table_result (ถ้าไม่ได้ผลจะคืนข้อความใน NO_RESULT_MESSAGES เสมอ:
+    DEBUG_FAILED_RESULT เมื่อดีบักครบทุกรอบแล้วยัง FAILED, QUERY_ABORTED_RESULT เมื่อ statement ถูก abort)
+    """
+    desc = _poll_statement(response['Id'])
+    attempts = 0
+    for attempt in range(1, MAX_DEBUG_TRIES + 1):
+        if desc['Status'] != 'FAILED':
+            break
+        attempts = attempt
+        bad_sql, error = desc['QueryString'], desc.get('Error', 'Unknown error')
+        print(f"\nDEBUG TRIAL {attempt}\nBAD SQL:\n{bad_sql}\nERROR: {error}\nDEBUGGING...")
+        if on_debug:
+            on_debug(attempt, error)
+        q_s = _extract_sql(llm_debugger(bad_sql, error, debug_context))
+        print(f"\nDEBUGGED SQL:\n{q_s}")
+        response = execute_query_redshift(q_s, conn_param, database, sql_parameters)
+        desc = _poll_statement(response['Id'])
+
+    if desc['Status'] == 'ABORTED':
+        print(f'QUERY ABORTED AFTER {attempts} DEBUG ATTEMPT(S)')
+        return QUERY_ABORTED_RESULT, q_s
+    if desc['Status'] != 'FINISHED':
+        print(f'DEBUGGING FAILED IN {attempts} ATTEMPTS')
+        return DEBUG_FAILED_RESULT, q_s
+
+    stmt_result = REDSHIFT_DATA.get_statement_result(Id=response['Id'])
+    return get_redshift_table_result(stmt_result, as_dict), q_s
+
+
+def run_and_fetch(sql, conn_param, database, sql_parameters=None, debug_context=None, on_debug=None, as_dict=False):
+    """รัน SQL แล้วรอ/ดึงผลในคราวเดียว ถ้า FAILED ค่อยเข้า loop ดีบักของ redshift_querys
+
+    คืน (result_csv, sql ที่รันสำเร็จ) เหมือน redshift_querys
+    """
+    response = execute_query_redshift(sql, conn_param, database, sql_parameters)
+    return redshift_querys(sql, response, debug_context or {}, conn_param, database, sql_parameters,
+                           on_debug=on_debug, as_dict=as_dict)